@@ -1,8 +1,8 @@
 from typing import Callable
-import torch
+import collections
+import itertools
 import numpy as np
 import torchvision
-import torchvision.transforms as transforms
 
 
 # Core dependencies
@@ -32,11 +32,13 @@ class LinearModel(pxc.EnergyModule):
         hidden_dim: int,
         output_dim: int,
         nm_layers: int,
-        act_fn: Callable[[jax.Array], jax.Array]
+        act_fn: Callable[[jax.Array], jax.Array],
+        compute_dtype: jnp.dtype = jnp.float32
     ) -> None:
         super().__init__()
 
         self.act_fn = px.static(act_fn)
+        self.compute_dtype = px.static(compute_dtype)
         
         self.layers = [pxnn.Linear(input_dim, hidden_dim)] + [
             pxnn.Linear(hidden_dim, hidden_dim) for _ in range(nm_layers - 2)
@@ -61,6 +63,16 @@ class LinearModel(pxc.EnergyModule):
         # i.e., ...frozen = px.static(True)).
         self.vodes[-1].h.frozen = True
 
+    # The matrix multiplications are run in 'compute_dtype' (e.g., bfloat16, to halve the memory traffic
+    # and use the tensor cores), while the weights, the vodes and the energies stay in float32: the
+    # weights are only cast down for the product, and the result is cast back up before the bias.
+    def linear(self, l: pxnn.Linear, x: jax.Array) -> jax.Array:
+        dtype = self.compute_dtype.get()
+        x = (l.nn.weight.get().astype(dtype) @ x.astype(dtype)).astype(jnp.float32)
+
+        # layers built with 'bias=False' have no bias Param at all ('nn.bias' is None).
+        return x + l.nn.bias.get() if l.nn.bias is not None else x
+
     def __call__(self, x, y, beta=1.0):
         for v, l in zip(self.vodes[:-1], self.layers[:-1]):
             # remember 'x = v(a)' corresponds to v.set("u", a); x = v.get("x")
@@ -69,9 +81,9 @@ class LinearModel(pxc.EnergyModule):
             # self.act_fn.get()(...), however, all standard methods such as __call__ and
             # __getitem__ are overloaded such that 'self.act_fn.__***__' becomes
             # 'self.act_fn.get().__***__'
-            x = v(self.act_fn(l(x)))
+            x = v(self.act_fn(self.linear(l, x)))
 
-        x = self.vodes[-1](self.layers[-1](x))
+        x = self.vodes[-1](self.linear(self.layers[-1], x))
 
         if y is not None:
             
@@ -80,95 +92,85 @@ class LinearModel(pxc.EnergyModule):
         return self.vodes[-1].get("u")
 
 
-# This is a simple collate function that stacks numpy arrays used to interface
-# the PyTorch dataloader with JAX. In the future we hope to provide custom dataloaders
-# that are independent of PyTorch.
+# MNIST is small enough (60k x 784 bytes, ~47MB) to be kept entirely in memory. Instead of running
+# the PyTorch transforms for every sample at every epoch (and paying for the worker processes), we
+# decode the whole dataset once into contiguous numpy arrays and simply iterate over shuffled slices
+# of it. Images are kept as uint8 and normalised on device (see 'normalise'). Note that the batch size
+# should be constant during training, so the last incomplete batch is dropped.
+class ArrayDataloader:
+    def __init__(self, x: np.ndarray, y: np.ndarray, batch_size: int, shuffle: bool = False):
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+        self.shuffle = shuffle
 
+    def __len__(self):
+        return len(self.x) // self.batch_size
 
-def numpy_collate(batch):
-    if isinstance(batch[0], np.ndarray):
-        return np.stack(batch)
-    elif isinstance(batch[0], (tuple, list)):
-        transposed = zip(*batch)
-        return [numpy_collate(samples) for samples in transposed]
-    else:
-        return np.array(batch)
+    def __iter__(self):
+        indices = np.random.permutation(len(self.x)) if self.shuffle else np.arange(len(self.x))
 
-
-# The dataloader assumes cuda is being used, as such it sets 'pin_memory = True' and
-# 'prefetch_factor = 2'. Note that the batch size should be constant during training, so
-# we set 'drop_last = True' to avoid having to deal with variable batch sizes.
-class TorchDataloader(torch.utils.data.DataLoader):
-    def __init__(
-        self,
-        dataset,
-        batch_size=1,
-        shuffle=None,
-        sampler=None,
-        batch_sampler=None,
-        num_workers=1,
-        pin_memory=True,
-        timeout=0,
-        worker_init_fn=None,
-        persistent_workers=True,
-        prefetch_factor=2,
-    ):
-        super(self.__class__, self).__init__(
-            dataset,
-            batch_size=batch_size,
-            shuffle=shuffle,
-            sampler=sampler,
-            batch_sampler=batch_sampler,
-            num_workers=num_workers,
-            collate_fn=numpy_collate,
-            pin_memory=pin_memory,
-            drop_last=True if batch_sampler is None else None,
-            timeout=timeout,
-            worker_init_fn=worker_init_fn,
-            persistent_workers=persistent_workers,
-            prefetch_factor=prefetch_factor,
-        )
+        for i in range(len(self)):
+            batch_indices = indices[i * self.batch_size:(i + 1) * self.batch_size]
+            yield self.x[batch_indices], self.y[batch_indices]
 
 
-def get_dataloaders(batch_size: int):
-    t = transforms.Compose([
-    transforms.ToTensor(),  # Converts to tensor
-    transforms.Normalize((0.5,), (0.5,)),  # Normalize with mean and std dev
-    transforms.Lambda(lambda x: torch.flatten(x)),  # Flatten the tensor
-    lambda x: x.numpy()
-    ])
-
-    train_dataset = torchvision.datasets.MNIST(
+def load_mnist(train: bool):
+    dataset = torchvision.datasets.MNIST(
         "~/tmp/mnist/",
-        transform=t,
         download=True,
-        train=True,
+        train=train,
     )
 
-    train_dataloader = TorchDataloader(
-        train_dataset,
+    x = dataset.data.numpy().reshape(len(dataset), -1)
+    y = dataset.targets.numpy().astype(np.int32)
+
+    return x, y
+
+
+def get_dataloaders(batch_size: int):
+    train_dataloader = ArrayDataloader(
+        *load_mnist(train=True),
         batch_size=batch_size,
         shuffle=True,
-        num_workers=4,
     )
 
-    test_dataset = torchvision.datasets.MNIST(
-        "~/tmp/mnist/",
-        transform=t,
-        download=True,
-        train=False,
-    )
-        
-    test_dataloader = TorchDataloader(
-        test_dataset,
+    test_dataloader = ArrayDataloader(
+        *load_mnist(train=False),
         batch_size=batch_size,
         shuffle=False,
-        num_workers=4,
     )
 
     return train_dataloader, test_dataloader
 
 
+# Double buffering of the host to device transfers: since jax dispatches asynchronously, copying
+# the next batch(es) with 'jax.device_put' before handing out the current one lets the transfer
+# overlap with the computation on the previous batch, instead of stalling at every call.
+def prefetch_to_device(dl, size: int = 2):
+    it = iter(dl)
+    queue = collections.deque(jax.device_put(batch) for batch in itertools.islice(it, size))
+
+    while queue:
+        batch = queue.popleft()
+        queue.extend(jax.device_put(batch) for batch in itertools.islice(it, 1))
+        yield batch
+
+
+# Groups 'size' consecutive batches into a single one with an extra leading dimension, to be consumed by
+# 'train_on_batches'. The last group may contain fewer batches (which causes one extra compilation).
+def stack_batches(dl, size: int):
+    it = iter(dl)
+    while batches := list(itertools.islice(it, size)):
+        yield tuple(np.stack(b) for b in zip(*batches))
+
+
+# Equivalent to ToTensor() followed by Normalize((0.5,), (0.5,)). It is called inside the jitted functions,
+# so the uint8 -> float32 conversion is fused with the first layer instead of being done on the host.
+def normalise(x: jax.Array) -> jax.Array:
+    return (x.astype(jnp.float32) / 255.0 - 0.5) / 0.5
+
+
 @pxf.vmap(pxu.Mask(pxc.VodeParam | pxc.VodeParam.Cache, (None, 0)), in_axes=(0, 0), out_axes=0)
 def forward(x, y, *, model: LinearModel, beta=1.0):
     return model(x, y, beta=beta)
@@ -184,6 +186,11 @@ def energy(x, *, model: LinearModel):
 def train_on_batch(T: int, x: jax.Array, y: jax.Array, *, model: LinearModel, optim_w: pxu.Optim, optim_h: pxu.Optim, beta: float = 1.0):
     model.train()
 
+    x = normalise(x)
+    # 'y' contains the integer labels: encoding them here lets XLA fuse the one-hot with the first
+    # use of the target, instead of dispatching a separate op (and allocation) for every batch.
+    y = jax.nn.one_hot(y, 10)
+
     # Init step
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         forward(x, y, model=model, beta=beta)
@@ -204,34 +211,61 @@ def train_on_batch(T: int, x: jax.Array, y: jax.Array, *, model: LinearModel, op
         _, g = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(energy)(x, model=model)
     optim_w.step(model, g["model"], mul=1/beta)
 
+
+# Runs 'train_on_batch' over a stack of batches (see 'stack_batches') with a scan, so that several training steps
+# are executed by a single compiled call. This removes the per-batch dispatch overhead, which dominates for a model
+# as small as this one.
+@pxf.jit(static_argnums=0)
+def train_on_batches(T: int, xs: jax.Array, ys: jax.Array, *, model: LinearModel, optim_w: pxu.Optim, optim_h: pxu.Optim, beta: float = 1.0):
+    def step(batch, beta, *, model, optim_w, optim_h):
+        train_on_batch(T, *batch, model=model, optim_w=optim_w, optim_h=optim_h, beta=beta)
+        return (beta,), None
+
+    pxf.scan(step, xs=(xs, ys))(beta, model=model, optim_w=optim_w, optim_h=optim_h)
+
+
 @pxf.jit()
 def eval_on_batch(x: jax.Array, y: jax.Array, *, model: LinearModel):
     model.eval()
+    x = normalise(x)
 
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         y_ = forward(x, None, model=model).argmax(axis=-1)
 
-    return (y_ == y).mean(), y_
+    return (y_ == y).sum(), y_
 
 
-def train(dl, T, *, model: LinearModel, optim_w: pxu.Optim, optim_h: pxu.Optim, beta: float = 1.0):
-    
-    for i, (x, y) in enumerate(dl):
-        train_on_batch(
-            T, x, jax.nn.one_hot(y, 10), model=model, optim_w=optim_w, optim_h=optim_h, beta=beta
-        )
+def train(dl, T, *, model: LinearModel, optim_w: pxu.Optim, optim_h: pxu.Optim, beta: float = 1.0, steps_per_jit: int = 1):
+    # 'beta' changes between epochs: it is moved to device once here, as a traced scalar, rather than being
+    # converted again for every batch.
+    beta = jnp.asarray(beta, dtype=jnp.float32)
+
+    if steps_per_jit > 1:
+        for xs, ys in prefetch_to_device(stack_batches(dl, steps_per_jit)):
+            train_on_batches(
+                T, xs, ys, model=model, optim_w=optim_w, optim_h=optim_h, beta=beta
+            )
+    else:
+        for x, y in prefetch_to_device(dl):
+            train_on_batch(
+                T, x, y, model=model, optim_w=optim_w, optim_h=optim_h, beta=beta
+            )
 
 
 def eval(dl, *, model: LinearModel):
-    acc = []
+    # The number of correct predictions is accumulated on device, so that it is copied to the host only once
+    # at the end of the epoch (instead of syncing with every single batch result).
+    nm_correct = jnp.zeros((), dtype=jnp.int32)
+    nm_total = 0
     ys_ = []
 
-    for x, y in dl:
-        a, y_ = eval_on_batch(x, y, model=model)
-        acc.append(a)
+    for x, y in prefetch_to_device(dl):
+        c, y_ = eval_on_batch(x, y, model=model)
+        nm_correct = nm_correct + c
+        nm_total += x.shape[0]
         ys_.append(y_)
 
-    return np.mean(acc), np.concatenate(ys_)
+    return (nm_correct / nm_total).item(), np.concatenate(jax.device_get(ys_))
 
 
 def main(run_info):
@@ -243,7 +277,8 @@ def main(run_info):
         hidden_dim=128,
         nm_layers=4,
         output_dim=10, 
-        act_fn=getattr(jax.nn, run_info["hp/act_fn"]))
+        act_fn=getattr(jax.nn, run_info["hp/act_fn"]),
+        compute_dtype=getattr(jnp, run_info["hp/compute_dtype"]))
     
     train_dataloader, test_dataloader = get_dataloaders(batch_size)
 
@@ -274,7 +309,10 @@ def main(run_info):
             beta = 1.0
         elif beta <= -1.0:
             beta = -1.0
-        train(train_dataloader, T=run_info["hp/T"], model=model, optim_w=optim_w, optim_h=optim_h, beta=beta)
+        train(
+            train_dataloader, T=run_info["hp/T"], model=model, optim_w=optim_w, optim_h=optim_h, beta=beta,
+            steps_per_jit=run_info["hp/steps_per_jit"],
+        )
         a, y = eval(test_dataloader, model=model)
         accuracies.append(float(a))
         
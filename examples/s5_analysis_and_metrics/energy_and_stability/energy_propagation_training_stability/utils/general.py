@@ -12,7 +12,6 @@ import numpy as np
 import jax
 import jax.numpy as jnp
 import optax
-from jax.tree_util import tree_map
 
 import pcax as px
 import pcax.predictive_coding as pxc
@@ -98,6 +97,12 @@ def energy(x, *, model: Model):
     return jax.lax.pmean(model.energy().sum(), "batch"), y_
 
 
+# The transformed energy functions do not depend on the batch, so they are built once at import time
+# instead of every time `train_on_batch` is traced.
+inference_step = pxf.value_and_grad(pxu.Mask(pxu.m(pxc.VodeParam).has_not(frozen=True), [False, True]), has_aux=True)(energy)
+learning_step = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(energy)
+
+
 @pxf.jit(static_argnums=0)
 def train_on_batch(T: int, x: jax.Array, y: jax.Array, *, model: Model, optim_w: pxu.Optim, optim_h: pxu.Optim):
     model.train()
@@ -105,20 +110,28 @@ def train_on_batch(T: int, x: jax.Array, y: jax.Array, *, model: Model, optim_w:
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         forward(x, y, model=model)
 
-    energies_per_layer_list = []
-    for i in range(T):
+    # The number of inference steps is fixed, so we use a scan instead of unrolling the loop in python:
+    # XLA compiles a single step body, independently of T.
+    def h_step(i, x, energies_per_layer, *, model, optim_h):
         with pxu.step(model, clear_params=pxc.VodeParam.Cache):
-            (e, y_), g = pxf.value_and_grad(pxu.Mask(pxu.m(pxc.VodeParam).has_not(frozen=True), [False, True]), has_aux=True)(energy)(
-                x, model=model
-            )
-            energies_per_layer = {str(layer_idx): value_node.energy() for layer_idx, value_node in enumerate(model.vodes)}
-            energies_per_layer_list.append(energies_per_layer)
+            (e, y_), g = inference_step(x, model=model)
+            # all vodes share the batch dimension, so their energies are gathered into a single
+            # (num_layers, batch_size) array.
+            energies_per_layer = jnp.stack([value_node.energy() for value_node in model.vodes])
 
         if optim_h is not None:
             optim_h.step(model, g["model"], True)
 
+        return (x, energies_per_layer), None
+
+    # Only the energies of the last inference step are reported, so they are carried through the scan (and
+    # overwritten at each step) rather than stacked into a (T, num_layers, batch_size) output.
+    (_, energies_per_layer), _ = pxf.scan(h_step, xs=jnp.arange(T))(
+        x, jnp.zeros((len(model.vodes), x.shape[0])), model=model, optim_h=optim_h
+    )
+
     with pxu.step(model, clear_params=pxc.VodeParam.Cache):
-        (e, y_), g = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(energy)(x, model=model)
+        (e, y_), g = learning_step(x, model=model)
 
     optim_w.step(model, g["model"])
 
@@ -128,7 +141,7 @@ def train_on_batch(T: int, x: jax.Array, y: jax.Array, *, model: Model, optim_w:
     w_grad_vars_per_layer = {str(k): jnp.var(v.nn.weight.get()) for k, v in enumerate(g["model"].layers)}
 
     return {
-        "energies": energies_per_layer_list[-1],
+        "energies": {str(layer_idx): layer_energy for layer_idx, layer_energy in enumerate(energies_per_layer)},
         "w_grad_norms": w_grad_norms_per_layer,
         "w_norms": w_norms_per_layer,
         "w_grad_vars": w_grad_vars_per_layer,
@@ -180,7 +193,8 @@ def eval(dl, *, model: Model):
         n_total += x.shape[0]
         ys_.append(y_)
 
-    return jnp.array(n_correct / n_total), np.concatenate(ys_)
+    # fetch all the predictions with a single device to host transfer, instead of one per batch.
+    return jnp.array(n_correct / n_total), np.concatenate(jax.device_get(ys_))
 
 
 # we merge initialisation in a single function to be able to create multiple models.
@@ -372,12 +386,10 @@ def single_trial(
 
 
 def jax_tree_to_numpy(tree: dict | list) -> dict | list:
-    """Converts a JAX tree to numpy tree."""
+    """Converts a JAX tree to numpy tree.
 
-    def convert(x):
-        if isinstance(x, jnp.ndarray):
-            return np.array(x)
-        else:
-            return x
+    All the arrays are fetched with a single call to ``jax.device_get``, which starts every device to host copy
+    before waiting on any of them, rather than synchronising once per leaf.
+    """
 
-    return tree_map(convert, tree)
+    return jax.device_get(tree)
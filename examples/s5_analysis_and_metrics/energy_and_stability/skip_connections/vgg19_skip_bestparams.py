@@ -1,4 +1,14 @@
 from typing import Callable
+import collections
+import itertools
+import os
+
+# VGG19 with batch size 128 and T inference steps is close to the memory limit of most GPUs: let jax reserve 90% of
+# the device memory (instead of the default 75%). Since 'setdefault' is used, the value can still be overridden from
+# the command line, e.g., with XLA_PYTHON_CLIENT_PREALLOCATE=false or XLA_PYTHON_CLIENT_ALLOCATOR=platform (slower,
+# but it frees memory as soon as it is unused, which is useful to measure the actual peak usage).
+os.environ.setdefault("XLA_PYTHON_CLIENT_MEM_FRACTION", "0.9")
+
 import torch
 import numpy as np
 import torchvision
@@ -60,15 +70,15 @@ class VGGNet_skip(pxc.EnergyModule):
             if ind == 2:
                 long_skip_value = self.long_skip(x.flatten())
         x = x.flatten()
-        for ind, (block, node) in enumerate(zip(self.classifier_layers, self.vodes[len(self.feature_layers) :])):
+        for block, node in zip(self.classifier_layers[:-1], self.vodes[len(self.feature_layers) : -1]):
             for layer in block:
                 x = layer(x)
-            
-            
-            if ind == len(self.classifier_layers) - 1:
-                x = x + long_skip_value
-
             x = node(x)
+
+        # The long skip connection only enters the output layer.
+        for layer in self.classifier_layers[-1]:
+            x = layer(x)
+        x = self.vodes[-1](x + long_skip_value)
         if y is not None:
             self.vodes[-1].set("h", y)
         return self.vodes[-1].get("u")
@@ -253,6 +263,17 @@ def get_dataloaders(batch_size: int):
     return train_dataloader, test_dataloader
 
 
+# Overlaps the host to device copy of the next batches with the current step.
+def prefetch_to_device(dl, size: int = 2):
+    it = iter(dl)
+    queue = collections.deque(jax.device_put(batch) for batch in itertools.islice(it, size))
+
+    while queue:
+        batch = queue.popleft()
+        queue.extend(jax.device_put(batch) for batch in itertools.islice(it, 1))
+        yield batch
+
+
 @pxf.vmap(pxu.Mask(pxc.VodeParam | pxc.VodeParam.Cache, (None, 0)), in_axes=(0, 0), out_axes=0)
 def forward(x, y, *, model: VGGNet_skip):
     return model(x, y)
@@ -263,39 +284,39 @@ def energy(x, *, model: VGGNet_skip):
     y_ = model(x, None)
     return jax.lax.pmean(model.energy().sum(), "batch"), y_
 
-@pxf.jit(static_argnums=[0,6])
+
+# Built once, instead of at every trace of 'train_on_batch'.
+inference_step = pxf.value_and_grad(pxu.Mask(pxu.m(pxc.VodeParam).has_not(frozen=True), [False, True]), has_aux=True)(energy)
+learning_step = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(energy)
+
+
+@pxf.jit(static_argnums=[0,6], donate_argnames=("model", "optim_w", "optim_h"))
 def train_on_batch(T: int, x: jax.Array, y: jax.Array, *, model: VGGNet_skip, optim_w: pxu.Optim, optim_h: pxu.Optim):
     model.train()
-    optim_h.init(model)
+    optim_h.init(pxu.Mask(pxu.m(pxc.VodeParam).has_not(frozen=True))(model))
+
+    # one-hot inside jit, so it is fused instead of dispatched per batch
+    y = jax.nn.one_hot(y, model.nm_classes.get())
 
     # Init step
     with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
         forward(x, y, model=model)
 
-    # r = []
-    # Inference steps
-    for _ in range(T):
+    # Inference steps (scanned, so the VGG19 step body is compiled once)
+    def h_step(i, x, *, model, optim_h):
         with pxu.step(model, clear_params=pxc.VodeParam.Cache):
-            _, g = pxf.value_and_grad(pxu.Mask(pxu.m(pxc.VodeParam).has_not(frozen=True), [False, True]), has_aux=True)(
-                energy
-            )(x, model=model)
+            _, g = inference_step(x, model=model)
 
         optim_h.step(model, g["model"])
-        # r.append(
-        #     jnp.stack(
-        #         [
-        #             jnp.mean(jnp.linalg.norm(jnp.reshape(u.h.get(), (-1, x.shape[0])), axis=-1))
-        #             for u in updates.vodes[:-1]
-        #         ]
-        #     )
-        # )
+        return x, None
+
+    pxf.scan(h_step, xs=jnp.arange(T))(x, model=model, optim_h=optim_h)
 
     # Learning step
     with pxu.step(model, clear_params=pxc.VodeParam.Cache):
-        _, g1 = pxf.value_and_grad(pxu.Mask(pxnn.LayerParam, [False, True]), has_aux=True)(energy)(x, model=model)
+        _, g1 = learning_step(x, model=model)
     
     optim_w.step(model, g1["model"])
-    # return jnp.stack(r)
 
 
 @pxf.jit()
@@ -310,21 +331,22 @@ def eval_on_batch(x: jax.Array, y: jax.Array, *, model: VGGNet_skip):
 
 def train(dl, T, *, model: VGGNet_skip, optim_w: pxu.Optim, optim_h: pxu.Optim):
     
-    for i, (x, y) in enumerate(dl):
-        train_on_batch(
-            T, x, jax.nn.one_hot(y, model.nm_classes.get()), model=model, optim_w=optim_w, optim_h=optim_h
-        )
+    for x, y in prefetch_to_device(dl):
+        train_on_batch(T, x, y, model=model, optim_w=optim_w, optim_h=optim_h)
 
 def eval(dl, *, model: VGGNet_skip):
-    acc = []
+    # The accuracy is accumulated on device and the predictions are copied to the host in a single transfer at the
+    # end of the epoch, instead of syncing with every batch. All batches have the same size (drop_last=True), so
+    # the mean of the batch accuracies is the overall accuracy.
+    acc = jnp.zeros(())
     ys_ = []
 
-    for x, y in dl:
+    for x, y in prefetch_to_device(dl):
         a, y_ = eval_on_batch(x, y, model=model)
-        acc.append(a)
+        acc = acc + a
         ys_.append(y_)
 
-    return np.mean(acc), np.concatenate(ys_)
+    return (acc / len(ys_)).item(), np.concatenate(jax.device_get(ys_))
 
 
 
@@ -4,13 +4,14 @@ __all__ = [
     "cond",
     "switch",
     "jit",
+    "checkpoint",
     "vmap",
     "value_and_grad",
 ]
 
 from typing import Any, Hashable, Sequence, Callable
 
-from ._transform import _BaseTransform, Jit, Vmap, ValueAndGrad
+from ._transform import _BaseTransform, Jit, Checkpoint, Vmap, ValueAndGrad
 from ._flow import Scan, WhileLoop, Cond, Switch
 
 
@@ -74,6 +75,17 @@ def jit(
     return decorator
 
 
+def checkpoint(
+    prevent_cse: bool = True,
+    policy: Callable[..., bool] | None = None,
+    static_argnums: int | Sequence[int] = (),
+):
+    def decorator(fn: _BaseTransform | Callable):
+        return Checkpoint(fn, prevent_cse=prevent_cse, policy=policy, static_argnums=static_argnums)
+
+    return decorator
+
+
 def vmap(
     kwargs_mask: Any = {},
     in_axes: Sequence[int | None] = (),
@@ -262,6 +262,26 @@ class Jit(_BaseTransform):
         return _r, kwargs
 
 
+class Checkpoint(_BaseTransform):
+    """
+    Wrap around jax.checkpoint(fn, ...).
+
+    The intermediate values computed inside fn are not stored for the backward pass but recomputed, trading compute
+    for memory (e.g., the activations of a deep model). Which values are saved anyway can be selected with 'policy'
+    (see jax.checkpoint_policies). The parameters in kwargs are treated as any other input and output of fn.
+    """
+
+    def __init__(self, fn: "_BaseTransform" | Callable, **t_kwargs: Any):
+        super().__init__(fn)
+
+        self.wrap_fn = jax.checkpoint(self.fn, **t_kwargs)
+
+    def _t(self, *args, **kwargs):
+        _r, kwargs = self.wrap_fn(*args, **kwargs)
+
+        return _r, kwargs
+
+
 class ValueAndGrad(_BaseTransform):
     """
     Wrap around jax.value_and_grad(fn, ...).
@@ -0,0 +1,88 @@
+import jax
+import jax.numpy as jnp
+
+import pcax as px
+import pcax.predictive_coding as pxc
+import pcax.nn as pxnn
+import pcax.utils as pxu
+import pcax.functional as pxf
+
+jax.config.update("jax_platform_name", "cpu")
+
+
+class Model(pxc.EnergyModule):
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.layers = [pxnn.Linear(4, 8, rkg=px.RandomKeyGenerator(0)), pxnn.Linear(8, 2, rkg=px.RandomKeyGenerator(1))]
+        self.vodes = [pxc.Vode((8,)), pxc.Vode((2,))]
+        self.vodes[-1].h.frozen = True
+
+    def __call__(self, x, y):
+        x = self.vodes[0](jax.nn.tanh(self.layers[0](x)))
+        x = self.vodes[1](self.layers[1](x))
+
+        if y is not None:
+            self.vodes[-1].set("h", y)
+
+        return self.vodes[-1].get("u")
+
+
+@pxf.vmap(pxu.Mask(pxc.VodeParam | pxc.VodeParam.Cache, (None, 0)), in_axes=(0, 0), out_axes=0)
+def forward(x, y, *, model: Model):
+    return model(x, y)
+
+
+def _energy(x, *, model: Model):
+    y_ = model(x, None)
+    return jax.lax.pmean(model.energy().sum(), "batch"), y_
+
+
+energy = pxf.vmap(pxu.Mask(pxc.VodeParam | pxc.VodeParam.Cache, (None, 0)), in_axes=(0,), out_axes=(None, 0), axis_name="batch")(
+    _energy
+)
+checkpointed_energy = pxf.vmap(
+    pxu.Mask(pxc.VodeParam | pxc.VodeParam.Cache, (None, 0)), in_axes=(0,), out_axes=(None, 0), axis_name="batch"
+)(pxf.checkpoint(prevent_cse=False)(_energy))
+
+
+def _value_and_grad(energy_fn, mask):
+    model = Model()
+    x = jnp.linspace(-1.0, 1.0, 3 * 4).reshape(3, 4)
+    y = jnp.eye(3, 2)
+
+    with pxu.step(model, pxc.STATUS.INIT, clear_params=pxc.VodeParam.Cache):
+        forward(x, y, model=model)
+
+    with pxu.step(model, clear_params=pxc.VodeParam.Cache):
+        (e, (y_,)), g = pxf.value_and_grad(pxu.Mask(mask, [False, True]), has_aux=True)(energy_fn)(x, model=model)
+        # the energies are cached by the vodes inside the (checkpointed) function, so they must be tracked out of it.
+        energies = [v.energy() for v in model.vodes]
+
+    return e, y_, g["model"], energies
+
+
+def _assert_tree_allclose(a, b):
+    leaves_a, leaves_b = jax.tree_util.tree_leaves(a), jax.tree_util.tree_leaves(b)
+    assert len(leaves_a) == len(leaves_b) > 0
+    for leaf_a, leaf_b in zip(leaves_a, leaves_b):
+        assert jnp.allclose(leaf_a, leaf_b, atol=1e-6)
+
+
+def test_checkpoint_value_and_grad_matches():
+    for mask in (pxnn.LayerParam, pxu.m(pxc.VodeParam).has_not(frozen=True)):
+        e, y_, g, energies = _value_and_grad(energy, mask)
+        e_c, y_c, g_c, energies_c = _value_and_grad(checkpointed_energy, mask)
+
+        assert jnp.allclose(e, e_c)
+        assert jnp.allclose(y_, y_c)
+        _assert_tree_allclose(pxu.Mask(mask)(g), pxu.Mask(mask)(g_c))
+        _assert_tree_allclose(energies, energies_c)
+
+
+def test_checkpoint_jit():
+    e, _, g, _ = _value_and_grad(energy, pxnn.LayerParam)
+    e_c, _, g_c, _ = pxf.jit()(lambda: _value_and_grad(checkpointed_energy, pxnn.LayerParam))()
+
+    assert jnp.allclose(e, e_c)
+    _assert_tree_allclose(pxu.Mask(pxnn.LayerParam)(g), pxu.Mask(pxnn.LayerParam)(g_c))